@@ -0,0 +1,87 @@
+'''
+Holds the decoded pages of a single document while it is processed by the worker.
+
+Every page is decoded from its original upload exactly once. The resulting numpy buffer is
+used by the orientation and deskew stages, which only ever read it and replace it with their
+own result. The PIL image for the following stages (saving, ocr, thumbnail) is built from the
+final buffer once and reused, instead of converting the page for every stage. The numpy buffer
+is dropped at that point, so only one copy of the page is kept in memory.
+A page is released as soon as its last stage is done.
+
+Encode and decode operations are counted per page in `encodes` and `decodes`. This includes
+the ones done by tesseract, which the worker records through `count_encode` and `count_decode`.
+'''
+
+from collections import Counter
+import os
+
+from PIL import Image
+import numpy
+
+
+class PageCache(object):
+    def __init__(self, work_item):
+        # keep the work item instead of its folder, the folder is renamed once the date is known
+        self.work_item = work_item
+        self.buffers = {}
+        self.images = {}
+        self.infos = {}
+        self.decodes = Counter()
+        self.encodes = Counter()
+
+    def original_path(self, page):
+        return os.path.join(self.work_item["folder_name"], "paper.{}.original.jpg_bak".format(page))
+
+    def page_path(self, page):
+        return os.path.join(self.work_item["folder_name"], "paper.{}.jpg".format(page))
+
+    def array(self, page):
+        'Decoded buffer of the page, must not be modified in place.'
+        if page in self.images:
+            # buffer was already handed over to the PIL image, convert back instead of decoding again
+            return numpy.asarray(self.images[page])
+        if page not in self.buffers:
+            with Image.open(self.original_path(page)) as orig_image:
+                self.infos[page] = orig_image.info  # extract metadata
+                self.buffers[page] = numpy.asarray(orig_image)
+            self.decodes[page] += 1
+        return self.buffers[page]
+
+    def image(self, page):
+        'PIL image of the current buffer of the page, with the original image info restored. Must not be closed by the caller.'
+        if page not in self.images:
+            img = Image.fromarray(self.array(page))
+            img.info = self.infos[page]
+            self.images[page] = img
+            # the PIL image holds its own copy of the page, free the numpy buffer
+            del self.buffers[page]
+        return self.images[page]
+
+    def replace(self, page, array):
+        'Replace the buffer of the page with the result of a processing stage.'
+        self._close_image(page)
+        self.buffers[page] = array
+
+    def save(self, page):
+        'Encode the current buffer of the page to its paper.N.jpg file.'
+        self.image(page).save(self.page_path(page))
+        self.encodes[page] += 1
+        return self.page_path(page)
+
+    def count_encode(self, page):
+        'Record an encode done outside of the cache, e.g. a temporary file written by pytesseract.'
+        self.encodes[page] += 1
+
+    def count_decode(self, page):
+        'Record a decode done outside of the cache, e.g. tesseract reading the page.'
+        self.decodes[page] += 1
+
+    def release(self, page):
+        self._close_image(page)
+        self.buffers.pop(page, None)
+        self.infos.pop(page, None)
+
+    def _close_image(self, page):
+        img = self.images.pop(page, None)
+        if img is not None:
+            img.close()
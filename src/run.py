@@ -19,10 +19,15 @@ import uuid
 from requests import post
 
 from thumbnailer import cropped_thumbnail
+from pagecache import PageCache
 
 logging.basicConfig(level=logging.INFO)
 
 tess_language = "deu"
+# only the top part of the page is searched for dates, likely the letterhead
+letterhead_ratio = 0.40
+# the ocr band extends a few lines below, so lines starting in the letterhead are not cut off
+letterhead_padding = 0.05
 labels = {
     "_AUTO_DATED" : "rgb(252,175,62)",
     "_UN_DATED" : "rgb(252,175,61)"
@@ -209,29 +214,30 @@ def worker():
         logging.info("Processing document ...")
         file_labels = []
 
-        for i in range(1, work_item["current_page"]):
+        document_dated = False
+        first_text_page = None
+        last_text_page = None
 
-            original_input_jpg = os.path.join(work_item["folder_name"], "paper.{}.original.jpg_bak".format(i))
-            input_jpg = os.path.join(work_item["folder_name"], "paper.{}.jpg".format(i))
+        # every page is decoded once and shared between all stages
+        # tesseract decodes are counted in the cache as well
+        page_cache = PageCache(work_item)
 
-            orig_image = Image.open(original_input_jpg)
-            orig_info = orig_image.info  # extract metadata
-            img = numpy.array(orig_image)
-            orig_image.close()
+        for i in range(1, work_item["current_page"]):
 
             text_page = True
             try:
-                # find text orientation
-                tess_output = re.search(r'Rotate: (\d*)', pytesseract.image_to_osd(img, lang=tess_language))
+                # find text orientation, tesseract reads the original upload directly
+                page_cache.count_decode(i)
+                tess_output = re.search(r'Rotate: (\d*)', pytesseract.image_to_osd(page_cache.original_path(i), lang=tess_language))
                 # rotate image according to tesseract output
                 if tess_output is not None and tess_output.group(1) != "0":
                     angle = int(tess_output.group(1))
                     if angle == 90:
-                        img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+                        page_cache.replace(i, cv2.rotate(page_cache.array(i), cv2.ROTATE_90_CLOCKWISE))
                     elif angle == 180:
-                        img = cv2.rotate(img, cv2.ROTATE_180)
+                        page_cache.replace(i, cv2.rotate(page_cache.array(i), cv2.ROTATE_180))
                     elif angle == 270:
-                        img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+                        page_cache.replace(i, cv2.rotate(page_cache.array(i), cv2.ROTATE_90_COUNTERCLOCKWISE))
             except:
                 text_page = False
                 logging.warning("Error finding tesseract orientation. Is this a blank page?")
@@ -239,24 +245,28 @@ def worker():
             if text_page:
                 try:
                   # then deskew
-                  img = deskew(img)
+                  page_cache.replace(i, deskew(page_cache.array(i)))
                 except:
                   logging.warning("Error deskewing image, continuing with original")
 
-            # restore original image info
-            img = Image.fromarray(img)
-            img.info = orig_info
+            # write page, original image info is restored by the cache
+            page_cache.save(i)
 
-            # write page
-            img.save(input_jpg)
+            # try to guess date as soon as the first text page is available
+            if text_page and first_text_page is None:
+                first_text_page = i
+                document_dated = date_document(work_item, i, page_cache, file_labels)
 
             if text_page:
-                # generate hocr file
+                # generate hocr file, pytesseract writes the page to a lossless temporary file
                 try:
-                    hocr = (pytesseract.image_to_pdf_or_hocr(img, lang=tess_language, extension="hocr"))
+                    page_cache.count_encode(i)
+                    page_cache.count_decode(i)
+                    hocr = (pytesseract.image_to_pdf_or_hocr(page_cache.image(i), lang=tess_language, extension="hocr"))
                     hocr_file_path = os.path.join(work_item["folder_name"], "paper.{}.words".format(i))
                     with open(hocr_file_path, "wb") as hocr_file:
                         hocr_file.write(hocr)
+                    last_text_page = i
                 except:
                     logging.error("pyTesseract threw error. No hocr file generated")
 
@@ -266,72 +276,26 @@ def worker():
             # generate thumbnails
             # must be exact size or they get regenerated by paperworks
             try:
-                thumbnail = cropped_thumbnail(img.copy(), (64, 80))
+                thumbnail = cropped_thumbnail(page_cache.image(i), (64, 80))
                 thumbnail.save(os.path.join(work_item["folder_name"], "paper.{}.thumb.jpg".format(i)))
+                page_cache.count_encode(i)
                 thumbnail.close()
             except:
                 logging.error("Could not generate thumbnail")
-            logging.info("Finished file...")
+            logging.info("Finished file... (%d decodes, %d encodes)", page_cache.decodes[i], page_cache.encodes[i])
 
-            img.close()
+            # thumbnail was the last stage, free the decoded page
+            page_cache.release(i)
 
 
-        # try to guess date
-        try:
-            logging.info("Guessing date...")
-            # get first page with hocr file
-            first_page_hocr = next(filter(
-                lambda path: os.path.exists(path),
-                map(
-                    lambda num : os.path.join(work_item["folder_name"], "paper.{}.words".format(num)),
-                    range(1, work_item["current_page"])
-                )))
-
-            dates = find_promising_dates(first_page_hocr)
-
-            # when we havent found anything on the first page,
-            # check the last page, maybe scanned in wrong order
-            if len(dates) == 0:
-                last_page_hocr = next(filter(
-                    lambda path: os.path.exists(path),
-                    map(
-                        lambda num: os.path.join(work_item["folder_name"], "paper.{}.words".format(num)),
-                        range(work_item["current_page"] - 1, 0, -1)
-                    )))
-                dates = find_promising_dates(last_page_hocr)
-            seen_dates = {}
-            deduped_dates = [seen_dates.setdefault(x, x) for x in dates if x not in seen_dates]
-
-            if len(deduped_dates) > 1:
-                logging.info("Found more than one date candidate")
-            elif len(deduped_dates) == 0:
-                logging.warning("No date found")
-
-            # if we have at least one date, take the first (roughly topmost)
-            if len(deduped_dates) > 0:
-                date_str = deduped_dates[0].strftime('%Y%m%d_%H%M_%S')
-                logging.info("Using found date %s",date_str)
-                # find unused folder that matches dates
-                base_folder = os.path.join(output_folder,date_str)
-                valid_path = base_folder
-                folder_counter = 1
-                while os.path.exists(valid_path):
-                    valid_path = "{}_{}".format(base_folder, folder_counter)
-                    folder_counter += 1
-
-                logging.info("Renaming %s to %s",work_item["folder_name"], valid_path)
-                # actually rename folder
-                os.rename(work_item["folder_name"], valid_path)
-                work_item["folder_name"] = valid_path
-
-                # add label
-                file_labels.append("_AUTO_DATED")
-            else:
-                file_labels.append("_UN_DATED")
-        except:
-            logging.error("Error in guessing date, continuing")
+        # when we havent found anything on the first page,
+        # check the last page with hocr file, maybe scanned in wrong order.
+        # this also searches the full hocr of the first page, if the letterhead band missed the date
+        if not document_dated and last_text_page is not None:
+            document_dated = date_document(work_item, last_text_page, page_cache, file_labels)
+
+        if not document_dated:
             file_labels.append("_UN_DATED")
-            pass
 
         try:
             # store scan date in file
@@ -340,14 +304,7 @@ def worker():
                 scandate_file.write(datetime.today().strftime('%Y%m%d_%H%M_%S') + "\n")
 
             # store document labels in file
-            if len(file_labels) > 0:
-                labels_file_path = os.path.join(work_item["folder_name"], "labels")
-                with open(labels_file_path, "w") as label_file:
-                    for label in file_labels:
-                        if label in labels:
-                            label_file.write("{},{}\n".format(label, labels[label]))
-                        else:
-                            label_file.write("{},{}\n".format(label, "rgb(0,0,0)"))
+            write_labels(work_item["folder_name"], file_labels)
         except:
             logging.error("Error setting labels, continuing")
             pass
@@ -470,6 +427,86 @@ def finish_scan():
     current_scan = None
 
 
+# guess the document date from the letterhead of a single page
+# and rename the document folder accordingly. Returns whether the document was dated.
+def date_document(work_item, page_num, page_cache, file_labels):
+    try:
+        logging.info("Guessing date from page %d...", page_num)
+        dates = find_page_dates(page_cache, page_num)
+
+        seen_dates = {}
+        deduped_dates = [seen_dates.setdefault(x, x) for x in dates if x not in seen_dates]
+
+        if len(deduped_dates) > 1:
+            logging.info("Found more than one date candidate")
+        elif len(deduped_dates) == 0:
+            logging.warning("No date found on page %d", page_num)
+            return False
+
+        # if we have at least one date, take the first (roughly topmost)
+        date_str = deduped_dates[0].strftime('%Y%m%d_%H%M_%S')
+        logging.info("Using found date %s",date_str)
+
+        # a recovered scan may already have been renamed to this date before it crashed
+        current_name = os.path.basename(os.path.normpath(work_item["folder_name"]))
+        if re.match(r'^{}(_\d+)?$'.format(re.escape(date_str)), current_name):
+            logging.info("%s is already named after its date",work_item["folder_name"])
+        else:
+            # find unused folder that matches dates
+            base_folder = os.path.join(output_folder,date_str)
+            valid_path = base_folder
+            folder_counter = 1
+            while os.path.exists(valid_path):
+                valid_path = "{}_{}".format(base_folder, folder_counter)
+                folder_counter += 1
+
+            logging.info("Renaming %s to %s",work_item["folder_name"], valid_path)
+            # actually rename folder, remaining pages are written to the new location
+            os.rename(work_item["folder_name"], valid_path)
+            work_item["folder_name"] = valid_path
+    except:
+        logging.error("Error in guessing date, continuing")
+        return False
+
+    # add label right away, so the dated folder is labeled while the remaining pages are processed
+    file_labels.append("_AUTO_DATED")
+    try:
+        write_labels(work_item["folder_name"], file_labels)
+    except:
+        logging.error("Error setting labels, continuing")
+    return True
+
+
+def write_labels(folder_name, file_labels):
+    if len(file_labels) > 0:
+        labels_file_path = os.path.join(folder_name, "labels")
+        with open(labels_file_path, "w") as label_file:
+            for label in file_labels:
+                if label in labels:
+                    label_file.write("{},{}\n".format(label, labels[label]))
+                else:
+                    label_file.write("{},{}\n".format(label, "rgb(0,0,0)"))
+
+
+# find date candidates of a page by only running ocr on the letterhead band.
+# an already written full page hocr file is parsed instead.
+def find_page_dates(page_cache, page_num):
+    hocr_file_path = os.path.join(page_cache.work_item["folder_name"], "paper.{}.words".format(page_num))
+    if os.path.exists(hocr_file_path):
+        return find_promising_dates(ET.parse(hocr_file_path).getroot())
+
+    img = page_cache.image(page_num)
+    width, height = img.size
+    band = img.crop((0, 0, width, int(height * (letterhead_ratio + letterhead_padding))))
+    hocr = pytesseract.image_to_pdf_or_hocr(band, lang=tess_language, extension="hocr")
+    # pytesseract writes the band to a temporary file, which tesseract decodes again
+    page_cache.count_encode(page_num)
+    page_cache.count_decode(page_num)
+    band.close()
+    # band starts at the top of the page, so line positions still match the full page
+    return find_promising_dates(ET.fromstring(hocr), page_height=height)
+
+
 def deskew(im, max_skew=10):
     height = im.shape[0]
     width = im.shape[1]
@@ -505,17 +542,18 @@ def deskew(im, max_skew=10):
     return cv2.warpAffine(im, M, (width, height), borderMode=cv2.BORDER_REPLICATE)
 
 
-def find_promising_dates(file_name):
+def find_promising_dates(root, page_height=None):
     def get_bbox(title):
         return list(map(int, re.search(r'bbox (\d* \d* \d* \d*)', title).group(1).split(' ')))
 
-    root = ET.parse(file_name)
-
     # find the bbox of the first page (dinA4) to compute height
     page_title = \
         root.findall('./{http://www.w3.org/1999/xhtml}body/{http://www.w3.org/1999/xhtml}div[@class="ocr_page"]')[0].get(
             "title")
     page_bbox = get_bbox(page_title)
+    # when only a band of the page was ocred, the letterhead is relative to the full page
+    if page_height is None:
+        page_height = page_bbox[3]
 
     # now find all ocr_lines
     lines = root.findall('.//*[@class="ocr_line"]')
@@ -523,9 +561,8 @@ def find_promising_dates(file_name):
     def parse(bbox, text):
         # bbox =  x0 y0 x1 y1
 
-        # only consider dates within the first 40% of the page,
-        # likely the letterhead
-        if bbox[1] < page_bbox[3] * 0.40:
+        # only consider dates within the letterhead part of the page
+        if bbox[1] < page_height * letterhead_ratio:
             date = dateparser.parse(text, languages=['de'])
             if date is not None:
                 return date
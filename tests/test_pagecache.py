@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
+
+from pagecache import PageCache
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.work_item = {"id": "test", "folder_name": self.folder.name, "current_page": 2}
+        Image.new("RGB", (40, 60), "white").save(os.path.join(self.folder.name, "paper.1.original.jpg_bak"), format="JPEG")
+        self.page_cache = PageCache(self.work_item)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_page_is_decoded_once(self):
+        self.page_cache.array(1)
+        self.page_cache.array(1)
+        self.page_cache.image(1)
+        self.page_cache.image(1)
+        self.page_cache.array(1)
+
+        self.assertEqual(self.page_cache.decodes[1], 1)
+        self.assertEqual(self.page_cache.encodes[1], 0)
+
+    def test_image_drops_buffer(self):
+        self.page_cache.image(1)
+
+        self.assertNotIn(1, self.page_cache.buffers)
+
+    def test_save_counts_encode(self):
+        path = self.page_cache.save(1)
+
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.page_cache.encodes[1], 1)
+        self.assertEqual(self.page_cache.decodes[1], 1)
+
+    def test_replace_keeps_decode_count(self):
+        rotated = self.page_cache.array(1).transpose(1, 0, 2)
+        self.page_cache.replace(1, rotated)
+
+        self.assertEqual(self.page_cache.image(1).size, (60, 40))
+        self.assertEqual(self.page_cache.decodes[1], 1)
+
+    def test_release_frees_page(self):
+        self.page_cache.save(1)
+        self.page_cache.release(1)
+
+        self.assertEqual(self.page_cache.buffers, {})
+        self.assertEqual(self.page_cache.images, {})
+        self.assertEqual(self.page_cache.infos, {})
+
+
+if __name__ == "__main__":
+    unittest.main()